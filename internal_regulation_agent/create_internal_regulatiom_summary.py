@@ -1,6 +1,6 @@
 import os
 import os.path as osp
-import subprocess
+from typing import Dict, Iterable, List, Optional, Tuple
 
 from pydantic import BaseModel
 
@@ -11,6 +11,88 @@ class InternalRegulationSummary(BaseModel):
     file_name: str
     content: str
 
+    def content_for(self, keywords: Optional[Iterable[str]] = None) -> str:
+        """
+        Return only the lines of the summary that contain one of the keywords,
+        together with the directories they belong to and, for matching directories,
+        everything under them.
+        The whole summary is returned if no keywords are given or nothing matches.
+        """
+        keywords = [keyword.lower() for keyword in keywords or [] if keyword]
+        if not keywords:
+            return self.content
+
+        lines = self.content.splitlines()
+        selected = []
+        # [line, is_selected, is_matched] of the directories leading to the current line
+        ancestors: List[list] = []
+        for line in lines[1:]:
+            marker = max(line.find("├── "), line.find("└── "))
+            if marker < 0:
+                continue
+            del ancestors[marker // 4 :]
+            is_matched = any(ancestor[2] for ancestor in ancestors) or any(
+                keyword in line.lower() for keyword in keywords
+            )
+            if is_matched:
+                for ancestor in ancestors:
+                    if not ancestor[1]:
+                        selected.append(ancestor[0])
+                        ancestor[1] = True
+                selected.append(line)
+            ancestors.append([line, is_matched, is_matched])
+        if not selected:
+            return self.content
+        return "\n".join(lines[:1] + selected) + "\n"
+
+
+# Summaries already retrieved in this process, keyed by (base_dir, whether the summary
+# file was created, latest mtime of data/ or mtime of the existing summary file)
+_summary_cache: Dict[Tuple[str, bool, float], InternalRegulationSummary] = {}
+
+
+def _latest_mtime(path: str) -> float:
+    """
+    Return the latest mtime of path and all of its subdirectories.
+    A directory's mtime changes whenever an entry is added, removed or renamed in it,
+    so this changes whenever the file listing under path changes.
+    """
+    latest = os.stat(path).st_mtime
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                latest = max(latest, _latest_mtime(entry.path))
+    return latest
+
+
+def _tree(path: str, lines: List[str], prefix: str = "") -> Tuple[int, int]:
+    """
+    Append a `tree` style listing of the entries under path to lines.
+    Like `tree`, hidden entries whose names start with "." are left out.
+
+    Returns:
+        The number of directories and files found under path.
+    """
+    num_dirs, num_files = 0, 0
+    with os.scandir(path) as it:
+        entries = sorted(
+            (entry for entry in it if not entry.name.startswith(".")),
+            key=lambda entry: entry.name,
+        )
+    for i, entry in enumerate(entries):
+        is_last = i == len(entries) - 1
+        lines.append(prefix + ("└── " if is_last else "├── ") + entry.name)
+        if entry.is_dir(follow_symlinks=False):
+            num_dirs += 1
+            sub_dirs, sub_files = _tree(
+                entry.path, lines, prefix + ("    " if is_last else "│   ")
+            )
+            num_dirs += sub_dirs
+            num_files += sub_files
+        else:
+            num_files += 1
+    return num_dirs, num_files
+
 
 def create_internal_regulation_summary_file(
     base_dir: str, file_name: str
@@ -22,14 +104,11 @@ def create_internal_regulation_summary_file(
     data_dir = os.path.join(base_dir, "data")
     if not os.path.exists(data_dir):
         raise ValueError(f"{data_dir} does not exist.")
-    try:
-        # For Unix/Linux and macOS
-        result = subprocess.check_output(["tree", data_dir], text=True)
-    except FileNotFoundError:
-        # Error handling when the 'tree' command is not available
-        raise RuntimeError(
-            "The 'tree' command was not found. Please check if it is installed."
-        )
+    lines = [data_dir]
+    num_dirs, num_files = _tree(data_dir, lines)
+    lines.append("")
+    lines.append(f"{num_dirs} directories, {num_files} files")
+    result = "\n".join(lines) + "\n"
     output_file_path = os.path.join(base_dir, file_name)
     with open(output_file_path, "w") as file:
         file.write(result)
@@ -44,6 +123,20 @@ def retrieve_internal_regulation_summary(
     base_dir: str, skip_summary_file_creation: bool
 ) -> InternalRegulationSummary:
     summary_file_name = INTERNAL_REGULATION_SUMMARY_FILE_NAME
+    # An existing summary file is only read, so it is enough to check the file itself
+    # instead of walking data/
+    if skip_summary_file_creation:
+        summary_path = osp.join(base_dir, summary_file_name)
+        mtime = osp.getmtime(summary_path) if osp.exists(summary_path) else None
+    else:
+        data_dir = osp.join(base_dir, "data")
+        mtime = _latest_mtime(data_dir) if osp.exists(data_dir) else None
+    cache_key = None
+    if mtime is not None:
+        cache_key = (base_dir, not skip_summary_file_creation, mtime)
+    if cache_key in _summary_cache:
+        return _summary_cache[cache_key]
+
     if not skip_summary_file_creation:
         print("[[CREATE INTERNAL REGULATION SUMMARY FILE]]")
         internal_regulation_summary = create_internal_regulation_summary_file(
@@ -56,4 +149,6 @@ def retrieve_internal_regulation_summary(
                 file_name=summary_file_name,
                 content=f.read(),
             )
+    if cache_key is not None:
+        _summary_cache[cache_key] = internal_regulation_summary
     return internal_regulation_summary
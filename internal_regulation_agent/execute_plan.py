@@ -1,17 +1,29 @@
-import os
+import logging
 import os.path as osp
-from datetime import datetime
-from typing import Any, List
-
-from langchain_community.document_loaders import Docx2txtLoader
+import time
+from collections import deque
+from concurrent.futures import (FIRST_COMPLETED, Future, ThreadPoolExecutor,
+                                wait)
+from dataclasses import asdict
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+import orjson
 from pydantic import BaseModel, Field
 
 from internal_regulation_agent.create_internal_regulatiom_summary import (
     InternalRegulationSummary, retrieve_internal_regulation_summary)
-from internal_regulation_agent.generate_plan import Task, parse_json_to_tasks
-from internal_regulation_agent.llm import (AVAILABLE_LLMS, create_client,
+from internal_regulation_agent.generate_plan import (TASK_SCHEMA, Task,
+                                                     parse_json_to_tasks)
+from internal_regulation_agent.llm import (AVAILABLE_LLMS, CacheManager,
+                                           create_client,
                                            extract_json_between_markers,
-                                           get_response_from_llm)
+                                           get_cached_response_from_llm,
+                                           has_json_between_markers)
+from internal_regulation_agent.load_internal_regulation import (
+    discard_preloaded_internal_regulations, preload_internal_regulations,
+    take_preloaded_internal_regulation)
+
+logger = logging.getLogger(__name__)
 
 execution_prompt = """
 Please update the following internal regulation text if necessary to fulfill the user's request, based on the reason for reviewing the regulation.
@@ -85,158 +97,317 @@ class Regulation(BaseModel):
     )
 
 
-def retrieve_internal_regulation(base_dir: str, file_name: str) -> str:
+def _partial_format(template: str, **kwargs: Any) -> str:
+    """
+    Substitute only the given placeholders of template.
+    Braces in the substituted values are escaped, so the result can still be
+    filled in with str.format for the remaining placeholders.
     """
-    Retrieve internal regulation from the given file path.
+    for key, value in kwargs.items():
+        escaped_value = str(value).replace("{", "{{").replace("}", "}}")
+        template = template.replace("{" + key + "}", escaped_value)
+    return template
 
-    Args:
-        base_dir: str
-        file_name: str (docx, pdf, txt,...)
+
+# The schema is static, so it is generated and substituted only once
+_REGULATION_SCHEMA = orjson.dumps(Regulation.model_json_schema()).decode()
+_execution_prompt = _partial_format(execution_prompt, output_schema=_REGULATION_SCHEMA)
+
+
+def _is_regulation_output(content: str) -> bool:
+    json_output = extract_json_between_markers(content)
+    if json_output is None:
+        return False
+    try:
+        Regulation(**json_output)
+    except Exception:
+        return False
+    return True
+
+
+def execute_task(
+    query: str,
+    task: Task,
+    base_dir: str,
+    client: Any,
+    client_model: str,
+    cache: Optional[CacheManager] = None,
+) -> Optional[Regulation]:
     """
-    data_dir = os.path.join(base_dir, "data/")
-    if not os.path.exists(data_dir):
-        raise ValueError(f"{data_dir} doesn't exist.")
+    Retrieve a single internal regulation and ask the LLM to update it.
+    The regulation text is taken from the preloaded regulations if it is already loaded.
 
-    if file_name.endswith(".docx"):
-        loader = Docx2txtLoader(data_dir + file_name)
-        content = loader.load()
-    else:
-        # TODO: Implement other file types
-        raise NotImplementedError("Only docx files are supported at the moment.")
-    return content
+    Returns:
+        The resulting Regulation object, or None if the task failed.
+    """
+    try:
+        regulation_text = take_preloaded_internal_regulation(
+            base_dir, task.file_name
+        ).result()
+    except Exception as e:
+        # Tasks run in worker threads, and log records are written whole, unlike prints
+        logger.warning(
+            "Error retrieving internal regulation for file '%s': %s", task.file_name, e
+        )
+        return None
+
+    execution_system_message = _execution_prompt.format(
+        query=query,
+        current_task_check_reason=task.check_reason,
+        current_task_file_name=task.file_name,
+        regulation_text=regulation_text,
+    )
+
+    # EXECUTION TASK
+    user_message = "Please update the internal regulation."
+    try:
+        content, _ = get_cached_response_from_llm(
+            msg=user_message,
+            system_message=execution_system_message,
+            client=client,
+            model=client_model,
+            cache=cache,
+            category="execution",
+            validate=_is_regulation_output,
+        )
+    except Exception as e:
+        logger.warning(
+            "Error during LLM call for updating regulation '%s': %s", task.file_name, e
+        )
+        return None
+
+    logger.debug("[[EXECUTION]]: %s", content)
+
+    json_output = extract_json_between_markers(content)
+    if json_output is None:
+        logger.warning(
+            "Failed to extract JSON from the LLM output for file '%s'", task.file_name
+        )
+        return None
+
+    try:
+        return Regulation(**json_output)
+    except Exception as e:
+        logger.warning(
+            "Error converting JSON to Regulation for file '%s': %s", task.file_name, e
+        )
+        return None
 
 
 def execute_plan(
     query: str,
-    tasks: List[Task],
+    tasks: Iterable[Task],
     base_dir: str,
     client: Any,
     client_model: str,
     internal_regulation_summary: InternalRegulationSummary,
     time_out: int = 900,
+    max_concurrency: int = 4,
+    replan_interval: int = 8,
+    cache: Optional[CacheManager] = None,
+    summary_keywords: Optional[List[str]] = None,
 ) -> List[Regulation]:
     """
     Execute the plan to update internal regulations based on the user's request.
     The process is considered complete when all tasks are finished or the timeout is reached.
-    Additional tasks may be generated through replanning after each task is completed.
+    Up to max_concurrency tasks are executed concurrently, each started as soon as a
+    worker is free, so tasks of a streamed plan run while the rest is still generated.
+    Additional tasks may be generated through replanning, which runs once replan_interval
+    tasks have been completed since the last replanning, or when no tasks are left.
 
     Args:
-    tasks: List of task objects representing tasks to update.
+    tasks: Task objects representing tasks to update. If this is an iterator, such as the one
+        returned by stream_init_plan, it is read in a background thread and each task is
+        executed as soon as it arrives.
     base_dir: Base directory where the internal regulation files are located.
     client: LLM client (e.g., OpenAI API client).
     client_model: The LLM model name to be used.
     internal_regulation_summary: An object containing a summary of all internal regulations.
     time_out: Timeout in seconds for the overall processing (default is 900 seconds).
+    max_concurrency: Maximum number of tasks executed concurrently (default is 4).
+    replan_interval: Number of completed tasks between replannings (default is 8).
+    cache: Cache of LLM responses. Caching is disabled when None.
+    summary_keywords: If given, only the regulations matching these keywords are shown to the LLM.
 
     Returns:
         A list of updated Regulation objects.
     """
+    # Tasks that are still being planned are taken lazily, so that execution
+    # can start before the whole plan has been generated
+    if isinstance(tasks, Iterator):
+        planned_tasks, tasks = tasks, deque()
+    else:
+        planned_tasks, tasks = None, deque(tasks)
+    # File names that have already been scheduled, to skip duplicated proposals from replanning
+    seen_file_names = {task.file_name for task in tasks}
     updated_regulations = []
     completed_tasks = []
     failed_tasks = []
-    start_time = datetime.now()
-
-    while tasks:
-        current_time = datetime.now()
-        # TIMEOUT CHECK
-        if (current_time - start_time).seconds > time_out:
-            print(f"Timeout reached: {time_out} seconds.")
-            print(f"Completed tasks: {completed_tasks}")
-            print(f"Remaining tasks: {tasks}")
-            return updated_regulations
-
-        current_task = tasks.pop(0)
-        print("=====================================================")
-        print(f"[[Current Task]]: {current_task}")
-        print(f"[[Remaining Tasks]]: {len(tasks)}")
-        print(f"[[Completed Tasks]]: {len(completed_tasks)}")
-
-        try:
-            regulation_text = retrieve_internal_regulation(
-                base_dir, current_task.file_name
-            )
-        except Exception as e:
-            print(
-                f"Error retrieving internal regulation for file '{current_task.file_name}': {e}"
-            )
-            failed_tasks.append(current_task)
-            continue
-
-        execution_system_message = execution_prompt.format(
-            query=query,
-            current_task_check_reason=current_task.check_reason,
-            current_task_file_name=current_task.file_name,
-            regulation_text=regulation_text,
-            output_schema=Regulation.model_json_schema(),
-        )
+    # Tasks completed since the last replanning
+    tasks_since_replanning = []
+    start_time = time.monotonic()
+    # Substitute the large, constant parts of the replanning prompt only once
+    replanning_template = _partial_format(
+        replanning_prompt,
+        query=query,
+        internal_regulation_summary=internal_regulation_summary.content_for(
+            summary_keywords
+        ),
+        output_schema=TASK_SCHEMA,
+    )
 
-        # EXECUTION TASK
-        user_message = "Please update the internal regulation."
-        try:
-            content, _ = get_response_from_llm(
-                msg=user_message,
-                system_message=execution_system_message,
-                client=client,
-                model=client_model,
-            )
-        except Exception as e:
-            print(f"Error during LLM call for updating regulation: {e}")
-            continue
-
-        print(f"[[EXECUTION]]: {content}")
-
-        json_output = extract_json_between_markers(content)
-        if json_output is None:
-            raise ValueError("Failed to extract JSON from the LLM output.")
-
-        try:
-            regulation = Regulation(**json_output)
-            updated_regulations.append(regulation)
-        except Exception as e:
-            print(
-                f"Error converting JSON to Regulation for file '{current_task.file_name}': {e}"
+    executor = ThreadPoolExecutor(max_workers=max_concurrency)
+    # The planned tasks are read from the stream in their own thread, one at a time,
+    # so that waiting for the next planned task never blocks the tasks that already arrived
+    planner = ThreadPoolExecutor(max_workers=1)
+    next_planned_task: Optional[Future] = None
+    if planned_tasks is not None:
+        next_planned_task = planner.submit(next, planned_tasks, None)
+    # Tasks being executed, keyed by their futures
+    running_tasks: Dict[Future, Task] = {}
+    try:
+        # Load the regulations in the background while the LLM calls are in flight
+        preload_internal_regulations(base_dir, [task.file_name for task in tasks])
+        while tasks or running_tasks or next_planned_task is not None:
+            # TIMEOUT CHECK
+            remaining_time = time_out - (time.monotonic() - start_time)
+            if remaining_time <= 0:
+                print(f"Timeout reached: {time_out} seconds.")
+                print(f"Completed tasks: {completed_tasks}")
+                print(f"Running tasks: {list(running_tasks.values())}")
+                print(f"Remaining tasks: {list(tasks)}")
+                print(f"Failed tasks: {failed_tasks}")
+                return updated_regulations
+
+            # EXECUTION TASKS (the LLM calls are I/O bound, so run them in threads)
+            started_tasks = []
+            while tasks and len(running_tasks) < max_concurrency:
+                task = tasks.popleft()
+                future = executor.submit(
+                    execute_task,
+                    query,
+                    task,
+                    base_dir,
+                    client,
+                    client_model,
+                    cache=cache,
+                )
+                running_tasks[future] = task
+                started_tasks.append(task)
+            if started_tasks:
+                print("=====================================================")
+                print(f"[[Started Tasks]]: {started_tasks}")
+                print(f"[[Running Tasks]]: {len(running_tasks)}")
+                print(f"[[Remaining Tasks]]: {len(tasks)}")
+                print(f"[[Completed Tasks]]: {len(completed_tasks)}")
+
+            # Wait until a task finishes or the next planned task arrives
+            waiting = list(running_tasks)
+            if next_planned_task is not None:
+                waiting.append(next_planned_task)
+            done, _ = wait(waiting, timeout=remaining_time, return_when=FIRST_COMPLETED)
+
+            if next_planned_task in done:
+                planned_task = next_planned_task.result()
+                if planned_task is None:
+                    next_planned_task = None
+                else:
+                    next_planned_task = planner.submit(next, planned_tasks, None)
+                    if planned_task.file_name not in seen_file_names:
+                        seen_file_names.add(planned_task.file_name)
+                        preload_internal_regulations(base_dir, [planned_task.file_name])
+                        tasks.append(planned_task)
+            for future in done:
+                task = running_tasks.pop(future, None)
+                if task is None:
+                    continue
+                regulation = future.result()
+                if regulation is None:
+                    failed_tasks.append(task)
+                    continue
+                updated_regulations.append(regulation)
+                completed_tasks.append(task)
+                tasks_since_replanning.append(task)
+            # Replan only every replan_interval completed tasks, or when nothing is left
+            if not tasks_since_replanning:
+                continue
+            if len(tasks_since_replanning) < replan_interval and (
+                tasks or running_tasks or next_planned_task is not None
+            ):
+                continue
+
+            # REPLANNING
+            user_message = (
+                "Please replan whether further internal regulation reviews are necessary."
             )
-            continue
-
-        completed_tasks.append(current_task)
-
-        # REPLANNING
-        user_message = (
-            "Please replan whether further internal regulation reviews are necessary."
-        )
-        replanning_system_message = replanning_prompt.format(
-            updated_regulations=updated_regulations,
-            tasks=tasks,
-            query=query,
-            internal_regulation_summary=internal_regulation_summary.content,
-            current_regulation=current_task.file_name,
-            output_schema=Task.model_json_schema(),
-        )
-
-        try:
-            context, _ = get_response_from_llm(
-                msg=user_message,
-                system_message=replanning_system_message,
-                client=client,
-                model=client_model,
+            replanning_system_message = replanning_template.format(
+                # Only a summary of each regulation is needed to decide on additional
+                # tasks, so the full texts are left out to keep the prompt small
+                updated_regulations=orjson.dumps(
+                    [
+                        regulation.model_dump(
+                            include={"file_name", "is_updated", "reason"}
+                        )
+                        for regulation in updated_regulations
+                    ]
+                ).decode(),
+                tasks=orjson.dumps([asdict(task) for task in tasks]).decode(),
+                current_regulation=orjson.dumps(
+                    [task.file_name for task in tasks_since_replanning]
+                ).decode(),
             )
-            print(f"[[Additional Tasks]]: {context}")
-        except Exception as e:
-            print(f"Error during LLM call for replanning: {e}")
-            continue
-        new_tasks_json = extract_json_between_markers(context)
-        assert new_tasks_json is not None, "Failed to extract JSON from LLM output"
-
-        if isinstance(new_tasks_json, list) and len(new_tasks_json) > 0:
-            new_tasks = parse_json_to_tasks(new_tasks_json)
-            tasks.extend(new_tasks)
-        else:
-            print("No additional tasks to check.")
-    return updated_regulations
+            tasks_since_replanning = []
+
+            try:
+                context, _ = get_cached_response_from_llm(
+                    msg=user_message,
+                    system_message=replanning_system_message,
+                    client=client,
+                    model=client_model,
+                    cache=cache,
+                    category="replanning",
+                    validate=has_json_between_markers,
+                )
+                logger.debug("[[Additional Tasks]]: %s", context)
+            except Exception as e:
+                logger.warning("Error during LLM call for replanning: %s", e)
+                continue
+            new_tasks_json = extract_json_between_markers(context)
+            assert new_tasks_json is not None, "Failed to extract JSON from LLM output"
+
+            new_tasks = []
+            if isinstance(new_tasks_json, list):
+                for new_task in parse_json_to_tasks(new_tasks_json):
+                    if new_task.file_name not in seen_file_names:
+                        seen_file_names.add(new_task.file_name)
+                        new_tasks.append(new_task)
+            if new_tasks:
+                preload_internal_regulations(
+                    base_dir, [task.file_name for task in new_tasks]
+                )
+                tasks.extend(new_tasks)
+            else:
+                print("No additional tasks to check.")
+        if failed_tasks:
+            print(f"Failed tasks: {failed_tasks}")
+        return updated_regulations
+    finally:
+        # Tasks still running after the timeout finish in the background
+        executor.shutdown(wait=False, cancel_futures=True)
+        planner.shutdown(wait=False, cancel_futures=True)
+        # Regulations preloaded for tasks that were never executed, e.g. after the
+        # timeout, are released so that their texts are not kept for the process lifetime
+        discard_preloaded_internal_regulations(base_dir)
 
 
 if __name__ == "__main__":
     import argparse
+    import os
+
+    # The LLM outputs are logged at DEBUG, so they are shown by default here
+    logging.basicConfig(
+        level=os.environ.get("AGENT_LOG", "DEBUG").upper(), format="%(message)s"
+    )
 
     parser = argparse.ArgumentParser(
         description="Generate Internal Regulation Agent plan"
@@ -1,13 +1,24 @@
+import logging
 import os.path as osp
-from typing import Any, Dict, List
+from dataclasses import dataclass
+from typing import Annotated, Any, Dict, Iterator, List, Optional
 
-from pydantic import BaseModel, Field
+import orjson
+from pydantic import Field, TypeAdapter
 
 from internal_regulation_agent.create_internal_regulatiom_summary import (
     InternalRegulationSummary, retrieve_internal_regulation_summary)
-from internal_regulation_agent.llm import (AVAILABLE_LLMS, create_client,
+from internal_regulation_agent.llm import (AVAILABLE_LLMS, CacheManager,
+                                           create_client,
                                            extract_json_between_markers,
-                                           get_response_from_llm)
+                                           get_cached_response_from_llm,
+                                           get_cached_response_from_llm_stream,
+                                           has_json_between_markers,
+                                           iter_json_objects_from_stream)
+from internal_regulation_agent.load_internal_regulation import \
+    preload_internal_regulations
+
+logger = logging.getLogger(__name__)
 
 planning_prompt = """
 You are tasked with updating the internal regulations of your company.
@@ -35,9 +46,20 @@ This JSON will be automatically parsed, so ensure the format is precise.
 """
 
 
-class Task(BaseModel):
-    file_name: str = Field(title="Internal regulation file name (excluding 'data/')")
-    check_reason: str = Field(title="Reason for reviewing the file (Japanese)")
+# A plain dataclass is used since many tasks are created from the LLM output;
+# pydantic is only used to generate the schema shown to the LLM.
+@dataclass(slots=True)
+class Task:
+    file_name: Annotated[
+        str, Field(title="Internal regulation file name (excluding 'data/')")
+    ]
+    check_reason: Annotated[
+        str, Field(title="Reason for reviewing the file (Japanese)")
+    ]
+
+
+# The schema is static, so it is generated only once
+TASK_SCHEMA = orjson.dumps(TypeAdapter(Task).json_schema()).decode()
 
 
 def parse_json_to_tasks(parsed_data: Dict) -> List[Task]:
@@ -76,11 +98,26 @@ def parse_json_to_tasks(parsed_data: Dict) -> List[Task]:
     return tasks
 
 
+def _format_planning_prompt(
+    internal_regulation_summary: InternalRegulationSummary,
+    summary_keywords: Optional[List[str]],
+) -> str:
+    return planning_prompt.format(
+        internal_regulation_summary=internal_regulation_summary.content_for(
+            summary_keywords
+        ),
+        output_schema=TASK_SCHEMA,
+    )
+
+
 def generate_init_plan(
     query: str,
     client: Any,
     model_name: str,
     internal_regulation_summary: InternalRegulationSummary,
+    cache: Optional[CacheManager] = None,
+    summary_keywords: Optional[List[str]] = None,
+    base_dir: Optional[str] = None,
 ) -> List[Task]:
     """
     Generates an update plan for internal regulations.
@@ -90,24 +127,29 @@ def generate_init_plan(
         client: OpenAI API client.
         model_name: The name of the model to be used.
         internal_regulation_summary: Summary information of internal regulations.
+        cache: Cache of LLM responses. Caching is disabled when None.
+        summary_keywords: If given, only the regulations matching these keywords are shown to the LLM.
+        base_dir: If given, the planned internal regulations are preloaded from this directory.
 
     Returns:
         A list of Task objects.
     """
 
-    planning_system_message = planning_prompt.format(
-        internal_regulation_summary=internal_regulation_summary.content,
-        output_schema=Task.model_json_schema(),
+    planning_system_message = _format_planning_prompt(
+        internal_regulation_summary, summary_keywords
     )
 
     # GENERATE PLAN
-    content, _ = get_response_from_llm(
+    content, _ = get_cached_response_from_llm(
         msg=query,
         system_message=planning_system_message,
         client=client,
         model=model_name,
+        cache=cache,
+        category="planning",
+        validate=has_json_between_markers,
     )
-    print(f"generated plan:{content}")
+    logger.debug("generated plan:%s", content)
 
     # PARSE OUTPUT
     json_output = extract_json_between_markers(content)
@@ -115,11 +157,73 @@ def generate_init_plan(
 
     # RESPONSE TO TASKS
     tasks = parse_json_to_tasks(json_output)
+
+    # PRELOAD PLANNED REGULATIONS
+    if base_dir is not None:
+        preload_internal_regulations(base_dir, [task.file_name for task in tasks])
     return tasks
 
 
+def stream_init_plan(
+    query: str,
+    client: Any,
+    model_name: str,
+    internal_regulation_summary: InternalRegulationSummary,
+    cache: Optional[CacheManager] = None,
+    summary_keywords: Optional[List[str]] = None,
+    base_dir: Optional[str] = None,
+) -> Iterator[Task]:
+    """
+    Streaming variant of generate_init_plan.
+    Each Task is yielded as soon as the LLM has finished writing it, so that
+    execute_plan can start on the first tasks while the rest of the plan is generated.
+
+    Parameters:
+        The same as generate_init_plan.
+
+    Yields:
+        Task objects.
+    """
+
+    planning_system_message = _format_planning_prompt(
+        internal_regulation_summary, summary_keywords
+    )
+
+    # GENERATE PLAN
+    chunks = get_cached_response_from_llm_stream(
+        msg=query,
+        system_message=planning_system_message,
+        client=client,
+        model=model_name,
+        cache=cache,
+        category="planning",
+        validate=has_json_between_markers,
+    )
+
+    # PARSE OUTPUT AS IT ARRIVES
+    # Duplicated tasks are skipped by execute_plan, so their files are preloaded once
+    preloaded_file_names = set()
+    found_json = False
+    for json_output in iter_json_objects_from_stream(chunks):
+        found_json = True
+        for task in parse_json_to_tasks(json_output):
+            logger.debug("[[PLANNED TASK]]: %s", task)
+            if base_dir is not None and task.file_name not in preloaded_file_names:
+                preloaded_file_names.add(task.file_name)
+                preload_internal_regulations(base_dir, [task.file_name])
+            yield task
+    if not found_json:
+        raise ValueError("Failed to extract JSON from LLM output")
+
+
 if __name__ == "__main__":
     import argparse
+    import os
+
+    # The generated plan is logged at DEBUG, so it is shown by default here
+    logging.basicConfig(
+        level=os.environ.get("AGENT_LOG", "DEBUG").upper(), format="%(message)s"
+    )
 
     parser = argparse.ArgumentParser(
         description="Generate Internal Regulation Agent plan"
@@ -1,15 +1,42 @@
-import json
+import functools
+import hashlib
 import os
+import os.path as osp
 import re
+import threading
+import time
+from typing import (Any, Callable, Dict, Iterable, Iterator, List, Optional,
+                    Tuple)
 
 import anthropic
 import backoff
 import google.generativeai as genai
 import openai
+import orjson
 from google.generativeai.types import GenerationConfig
 
 MAX_NUM_TOKENS = 4096
 
+# Patterns used to extract JSON from LLM outputs, compiled once at import time
+JSON_FENCE_PATTERN = re.compile(r"```json(.*?)```", re.DOTALL)
+JSON_OBJECT_PATTERN = re.compile(r"\{.*?\}", re.DOTALL)
+CONTROL_CHARS_PATTERN = re.compile(r"[\x00-\x1F\x7F]")
+
+# Transient API errors that are retried before giving up on a call
+RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.APIConnectionError,
+    openai.InternalServerError,
+    anthropic.RateLimitError,
+    anthropic.APIConnectionError,
+    anthropic.InternalServerError,
+    TimeoutError,
+)
+MAX_RETRIES = 5
+
+DEFAULT_CACHE_DIR = osp.join(osp.expanduser("~"), ".cache", "ira")
+DEFAULT_CACHE_EXPIRE_SECONDS = 7 * 24 * 60 * 60
+
 AVAILABLE_LLMS = [
     # Anthropic models
     "claude-3-5-sonnet-20240620",
@@ -126,8 +153,7 @@ def get_batch_responses_from_llm(
     return content, new_msg_history
 
 
-@backoff.on_exception(backoff.expo, (openai.RateLimitError, openai.APITimeoutError))
-def get_response_from_llm(
+def _get_response_from_llm(
     msg,
     client,
     model,
@@ -278,34 +304,379 @@ def get_response_from_llm(
     return content, new_msg_history
 
 
+get_response_from_llm = backoff.on_exception(
+    backoff.expo, (openai.RateLimitError, openai.APITimeoutError)
+)(_get_response_from_llm)
+
+# Retries transient API errors with exponential backoff up to MAX_RETRIES times
+_get_response_from_llm_with_retry = backoff.on_exception(
+    backoff.expo, RETRYABLE_ERRORS, max_tries=MAX_RETRIES, max_value=30
+)(_get_response_from_llm)
+
+
+@backoff.on_exception(
+    backoff.expo, RETRYABLE_ERRORS, max_tries=MAX_RETRIES, max_value=30
+)
+def _open_stream(create, **kwargs):
+    # Rate limits and connection errors are raised when the stream is opened,
+    # before any chunk is yielded, so retrying the opening call is enough
+    return create(**kwargs)
+
+
+def get_response_from_llm_stream(
+    msg,
+    client,
+    model,
+    system_message,
+    msg_history=None,
+    temperature=0.75,
+) -> Iterator[str]:
+    """
+    Streaming variant of get_response_from_llm, yielding the response text in chunks
+    as they arrive. Models without streaming support here are answered in one chunk.
+    Transient API errors are retried with exponential backoff up to MAX_RETRIES times.
+    """
+    if msg_history is None:
+        msg_history = []
+    new_msg_history = msg_history + [{"role": "user", "content": msg}]
+
+    if "claude" in model:
+        response = _open_stream(
+            client.messages.create,
+            model=model,
+            max_tokens=MAX_NUM_TOKENS,
+            temperature=temperature,
+            system=system_message,
+            messages=new_msg_history,
+            stream=True,
+        )
+        try:
+            for event in response:
+                if (
+                    event.type == "content_block_delta"
+                    and event.delta.type == "text_delta"
+                ):
+                    yield event.delta.text
+        finally:
+            response.close()
+    elif model in [
+        "gpt-4o-2024-11-20",
+        "gpt-4o-mini-2024-07-18",
+        "gpt-4o-2024-08-06",
+        "meta-llama/llama-3.1-405b-instruct",
+        "llama-3-1-405b-instruct",
+        "deepseek-chat",
+        "deepseek-coder",
+    ]:
+        response = _open_stream(
+            client.chat.completions.create,
+            model=("meta-llama/llama-3.1-405b-instruct" if "llama" in model else model),
+            messages=[
+                {"role": "system", "content": system_message},
+                *new_msg_history,
+            ],
+            temperature=temperature,
+            max_tokens=MAX_NUM_TOKENS,
+            n=1,
+            stop=None,
+            stream=True,
+            **({"seed": 0} if "gpt" in model else {}),
+        )
+        try:
+            for chunk in response:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        finally:
+            response.close()
+    elif "gemini" in model:
+        gemini_contents = [{"role": "system", "parts": system_message}]
+        for m in new_msg_history:
+            gemini_contents.append({"role": m["role"], "parts": m["content"]})
+        response = _open_stream(
+            client.generate_content,
+            contents=gemini_contents,
+            generation_config=GenerationConfig(
+                temperature=temperature,
+                max_output_tokens=MAX_NUM_TOKENS,
+                candidate_count=1,
+            ),
+            stream=True,
+        )
+        for chunk in response:
+            yield chunk.text
+    else:
+        content, _ = _get_response_from_llm_with_retry(
+            msg,
+            client,
+            model,
+            system_message,
+            msg_history=msg_history,
+            temperature=temperature,
+        )
+        yield content
+
+
+class CacheManager:
+    """
+    Persistent cache of LLM responses.
+    Each entry is stored as {cache_dir}/{category}/{hash}.json and expires after expire_seconds.
+    """
+
+    def __init__(
+        self,
+        cache_dir: str = DEFAULT_CACHE_DIR,
+        expire_seconds: int = DEFAULT_CACHE_EXPIRE_SECONDS,
+    ):
+        self.cache_dir = cache_dir
+        self.expire_seconds = expire_seconds
+
+    @staticmethod
+    def make_key(*parts: str) -> str:
+        return hashlib.md5("".join(parts).encode("utf-8")).hexdigest()
+
+    def _path(self, category: str, key: str) -> str:
+        return osp.join(self.cache_dir, category, f"{key}.json")
+
+    def get(self, category: str, key: str) -> Optional[Dict[str, Any]]:
+        path = self._path(category, key)
+        try:
+            with open(path, "rb") as f:
+                entry = orjson.loads(f.read())
+        except (FileNotFoundError, orjson.JSONDecodeError):
+            return None
+        if time.time() - entry["timestamp"] > self.expire_seconds:
+            return None
+        return entry
+
+    def set(self, category: str, key: str, entry: Dict[str, Any]) -> None:
+        path = self._path(category, key)
+        os.makedirs(osp.dirname(path), exist_ok=True)
+        entry = {**entry, "timestamp": time.time()}
+        # Write to a temporary file first so concurrent readers never see a partial entry
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(orjson.dumps(entry))
+        os.replace(tmp_path, path)
+
+
+def _make_response_cache_key(
+    system_message, msg, model, msg_history, temperature
+) -> str:
+    return CacheManager.make_key(
+        system_message,
+        msg,
+        model,
+        orjson.dumps(msg_history or []).decode(),
+        str(temperature),
+    )
+
+
+def get_cached_response_from_llm(
+    msg,
+    client,
+    model,
+    system_message,
+    cache: Optional[CacheManager] = None,
+    category: str = "default",
+    print_debug=False,
+    msg_history=None,
+    temperature=0.75,
+    validate: Optional[Callable[[str], bool]] = None,
+) -> Tuple[str, List[Dict[str, Any]]]:
+    """
+    Same as get_response_from_llm, but returns the cached response when the
+    same prompt has already been sent to the same model.
+    Transient API errors are retried with exponential backoff up to MAX_RETRIES times.
+    Caching is disabled when cache is None.
+    If validate is given, only responses for which it returns True are cached
+    or returned from the cache, so that unusable outputs are asked for again.
+    """
+    if cache is None:
+        return _get_response_from_llm_with_retry(
+            msg,
+            client,
+            model,
+            system_message,
+            print_debug=print_debug,
+            msg_history=msg_history,
+            temperature=temperature,
+        )
+
+    key = _make_response_cache_key(system_message, msg, model, msg_history, temperature)
+    entry = cache.get(category, key)
+    if entry is not None and (validate is None or validate(entry["content"])):
+        return entry["content"], entry["msg_history"]
+
+    content, new_msg_history = _get_response_from_llm_with_retry(
+        msg,
+        client,
+        model,
+        system_message,
+        print_debug=print_debug,
+        msg_history=msg_history,
+        temperature=temperature,
+    )
+    if validate is None or validate(content):
+        cache.set(category, key, {"content": content, "msg_history": new_msg_history})
+    return content, new_msg_history
+
+
+def get_cached_response_from_llm_stream(
+    msg,
+    client,
+    model,
+    system_message,
+    cache: Optional[CacheManager] = None,
+    category: str = "default",
+    msg_history=None,
+    temperature=0.75,
+    validate: Optional[Callable[[str], bool]] = None,
+) -> Iterator[str]:
+    """
+    Same as get_response_from_llm_stream, but yields the cached response in one chunk
+    when the same prompt has already been sent to the same model.
+    The response is cached only if the stream is consumed to the end and, if validate
+    is given, validate returns True for it.
+    """
+    if cache is None:
+        yield from get_response_from_llm_stream(
+            msg,
+            client,
+            model,
+            system_message,
+            msg_history=msg_history,
+            temperature=temperature,
+        )
+        return
+
+    key = _make_response_cache_key(system_message, msg, model, msg_history, temperature)
+    entry = cache.get(category, key)
+    if entry is not None and (validate is None or validate(entry["content"])):
+        yield entry["content"]
+        return
+
+    chunks = []
+    for chunk in get_response_from_llm_stream(
+        msg,
+        client,
+        model,
+        system_message,
+        msg_history=msg_history,
+        temperature=temperature,
+    ):
+        chunks.append(chunk)
+        yield chunk
+    content = "".join(chunks)
+    new_msg_history = (msg_history or []) + [
+        {"role": "user", "content": msg},
+        {"role": "assistant", "content": content},
+    ]
+    if validate is None or validate(content):
+        cache.set(category, key, {"content": content, "msg_history": new_msg_history})
+
+
 def extract_json_between_markers(llm_output):
-    # Regular expression pattern to find JSON content between ```json and ```
-    json_pattern = r"```json(.*?)```"
-    matches = re.findall(json_pattern, llm_output, re.DOTALL)
+    # Find JSON content between ```json and ```
+    matches = JSON_FENCE_PATTERN.findall(llm_output)
 
     if not matches:
         # Fallback: Try to find any JSON-like content in the output
-        json_pattern = r"\{.*?\}"
-        matches = re.findall(json_pattern, llm_output, re.DOTALL)
+        matches = JSON_OBJECT_PATTERN.findall(llm_output)
 
     for json_string in matches:
         json_string = json_string.strip()
         try:
-            parsed_json = json.loads(json_string)
+            parsed_json = orjson.loads(json_string)
             return parsed_json
-        except json.JSONDecodeError:
+        except orjson.JSONDecodeError:
             # Attempt to fix common JSON issues
             try:
                 # Remove invalid control characters
-                json_string_clean = re.sub(r"[\x00-\x1F\x7F]", "", json_string)
-                parsed_json = json.loads(json_string_clean)
+                json_string_clean = CONTROL_CHARS_PATTERN.sub("", json_string)
+                parsed_json = orjson.loads(json_string_clean)
                 return parsed_json
-            except json.JSONDecodeError:
+            except orjson.JSONDecodeError:
                 continue  # Try next match
 
     return None  # No valid JSON found
 
 
+def has_json_between_markers(llm_output) -> bool:
+    return extract_json_between_markers(llm_output) is not None
+
+
+def _loads_json(json_string):
+    try:
+        return orjson.loads(json_string)
+    except orjson.JSONDecodeError:
+        # Remove invalid control characters
+        return orjson.loads(CONTROL_CHARS_PATTERN.sub("", json_string))
+
+
+def iter_json_objects_from_stream(chunks: Iterable[str]) -> Iterator[Any]:
+    """
+    Yield the top-level JSON objects in the ```json block of a streamed LLM output,
+    each as soon as its closing brace arrives.
+    If no object can be parsed this way, extract_json_between_markers is applied
+    to the whole output once the stream ends.
+    """
+    text = ""
+    pos = None  # Position of the next character to scan in the ```json block
+    depth = 0
+    object_start = 0
+    in_string = False
+    escaped = False
+    done = False
+    found = False
+    for chunk in chunks:
+        text += chunk
+        if done:
+            continue
+        if pos is None:
+            marker = text.find("```json")
+            if marker < 0:
+                continue
+            pos = marker + len("```json")
+        while pos < len(text):
+            c = text[pos]
+            pos += 1
+            if in_string:
+                if escaped:
+                    escaped = False
+                elif c == "\\":
+                    escaped = True
+                elif c == '"':
+                    in_string = False
+            elif c == '"':
+                in_string = True
+            elif c == "{":
+                if depth == 0:
+                    object_start = pos - 1
+                depth += 1
+            elif c == "}" and depth > 0:
+                depth -= 1
+                if depth == 0:
+                    try:
+                        parsed_json = _loads_json(text[object_start:pos])
+                    except orjson.JSONDecodeError:
+                        continue
+                    found = True
+                    yield parsed_json
+            elif c == "`" and depth == 0:
+                # End of the ```json block
+                done = True
+                break
+
+    if not found:
+        parsed_json = extract_json_between_markers(text)
+        if isinstance(parsed_json, list):
+            yield from parsed_json
+        elif parsed_json is not None:
+            yield parsed_json
+
+
+# Clients are shared per model, so every module reuses the same connection pool
+@functools.lru_cache(maxsize=None)
 def create_client(model):
     if model.startswith("claude-"):
         print(f"Using Anthropic API with model {model}.")
@@ -0,0 +1,70 @@
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Iterable, Tuple
+
+import docx2txt
+
+# Internal regulations loaded in background threads, keyed by (base_dir, file_name)
+_preloaded: Dict[Tuple[str, str], Future] = {}
+_preloaded_lock = threading.Lock()
+_preload_executor = ThreadPoolExecutor(max_workers=8)
+
+
+def retrieve_internal_regulation(base_dir: str, file_name: str) -> str:
+    """
+    Retrieve internal regulation from the given file path.
+
+    Args:
+        base_dir: str
+        file_name: str (docx, pdf, txt,...)
+    """
+    data_dir = os.path.join(base_dir, "data/")
+    if not os.path.exists(data_dir):
+        raise ValueError(f"{data_dir} doesn't exist.")
+
+    if file_name.endswith(".docx"):
+        content = docx2txt.process(os.path.join(data_dir, file_name))
+    else:
+        # TODO: Implement other file types
+        raise NotImplementedError("Only docx files are supported at the moment.")
+    return content
+
+
+def _preload(base_dir: str, file_name: str) -> None:
+    # Must be called with _preloaded_lock held
+    key = (base_dir, file_name)
+    if key not in _preloaded:
+        _preloaded[key] = _preload_executor.submit(
+            retrieve_internal_regulation, base_dir, file_name
+        )
+
+
+def preload_internal_regulations(base_dir: str, file_names: Iterable[str]) -> None:
+    """
+    Start loading the given internal regulations in background threads,
+    so that their text is ready by the time the tasks are executed.
+    """
+    with _preloaded_lock:
+        for file_name in file_names:
+            _preload(base_dir, file_name)
+
+
+def take_preloaded_internal_regulation(base_dir: str, file_name: str) -> Future:
+    """
+    Return the future holding the text of an internal regulation and release it from
+    the preloaded regulations. The loading is started first if it was not preloaded.
+    """
+    with _preloaded_lock:
+        _preload(base_dir, file_name)
+        return _preloaded.pop((base_dir, file_name))
+
+
+def discard_preloaded_internal_regulations(base_dir: str) -> None:
+    """
+    Release the regulations preloaded from base_dir that were never taken,
+    cancelling the loads that have not started yet.
+    """
+    with _preloaded_lock:
+        for key in [key for key in _preloaded if key[0] == base_dir]:
+            _preloaded.pop(key).cancel()
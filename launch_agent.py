@@ -1,15 +1,23 @@
 import argparse
+import logging
+import os
 import os.path as osp
+import sys
 
 from internal_regulation_agent.create_internal_regulatiom_summary import \
     retrieve_internal_regulation_summary
 from internal_regulation_agent.execute_plan import execute_plan
-from internal_regulation_agent.generate_plan import generate_init_plan
+from internal_regulation_agent.generate_plan import stream_init_plan
 from internal_regulation_agent.generate_repot import generate_report
-from internal_regulation_agent.llm import AVAILABLE_LLMS, create_client
+from internal_regulation_agent.llm import (AVAILABLE_LLMS, CacheManager,
+                                           create_client)
 
 NUM_REFLECTIONS = 3
 TIME_OUT_SECONDS = 900
+MAX_CONCURRENT_TASKS = 4
+REPLAN_INTERVAL = 8
+
+logger = logging.getLogger(__name__)
 
 
 def parse_arguments():
@@ -39,15 +47,33 @@ def parse_arguments():
         default=False,
         help="Set to False when creating the internal_regulation_summary.txt file. If the file already exists, set it to True. Initially, it should be False.",
     )
+    parser.add_argument(
+        "--summary_keywords",
+        type=str,
+        nargs="*",
+        default=None,
+        help="Only show the LLM the internal regulation files and directories matching these keywords. By default, all files are shown.",
+    )
+    parser.add_argument(
+        "--no_cache",
+        action="store_true",
+        help="Disable the cache of LLM responses used for planning and execution.",
+    )
     return parser.parse_args()
 
 
 if __name__ == "__main__":
     args = parse_arguments()
+    # Set AGENT_LOG=DEBUG to also show the planned tasks, or WARNING to only show errors
+    logging.basicConfig(
+        level=os.environ.get("AGENT_LOG", "INFO").upper(), format="%(message)s"
+    )
 
     # Create client
     client, client_model = create_client(args.model)
 
+    cache = None if args.no_cache else CacheManager()
+
     base_dir = osp.join("templates", args.experiment)
     results_dir = osp.join("results", args.experiment)
 
@@ -55,17 +81,18 @@ if __name__ == "__main__":
         base_dir, skip_summary_file_creation=args.skip_summary_file_creation
     )
 
-    print("[[INIT PLANNING START]]")
-    tasks = generate_init_plan(
+    # The initial plan is streamed into execute_plan, so the first tasks are
+    # executed while the rest of the plan is still being generated
+    logger.info("[[INIT PLANNING AND EXECUTE PLAN START]]")
+    tasks = stream_init_plan(
         query=args.query,
         client=client,
         model_name=client_model,
         internal_regulation_summary=internal_regulation_summary,
+        cache=cache,
+        summary_keywords=args.summary_keywords,
+        base_dir=base_dir,
     )
-    print(f"[[INIT PLANNING RESULT]]:{tasks}")
-    print("[[INIT PLANNING END]]")
-
-    print("[[EXECUTE PLAN START]]")
     updated_regulations = execute_plan(
         query=args.query,
         tasks=tasks,
@@ -74,11 +101,15 @@ if __name__ == "__main__":
         client_model=client_model,
         internal_regulation_summary=internal_regulation_summary,
         time_out=TIME_OUT_SECONDS,
+        max_concurrency=MAX_CONCURRENT_TASKS,
+        replan_interval=REPLAN_INTERVAL,
+        cache=cache,
+        summary_keywords=args.summary_keywords,
     )
-    print("[[EXECUTE PLAN END]]")
+    logger.info("[[INIT PLANNING AND EXECUTE PLAN END]]")
 
     try:
-        print("[[REPORT START]]")
+        logger.info("[[REPORT START]]")
         success = generate_report(
             query=args.query,
             updated_regulations=updated_regulations,
@@ -86,11 +117,11 @@ if __name__ == "__main__":
             client=client,
             model_name=client_model,
         )
-        print(f" Success: {success}")
-        print("[[REPORT END]]")
+        logger.info("Success: %s", success)
+        logger.info("[[REPORT END]]")
     except Exception as e:
-        print(f"Failed to output pdf: {str(e)}")
-        import traceback
-
-        print(traceback.format_exc())
-    print("Task Completed.")
+        logger.exception("Failed to output pdf: %s", e)
+        sys.exit(1)
+    if not success:
+        sys.exit(1)
+    logger.info("Task Completed.")